@@ -1,12 +1,17 @@
+from functools import lru_cache
+from html import escape
+from itertools import chain
+from typing import cast
 from urllib.parse import urljoin
-import json
 import os
+import re
 
 import httpx
 import asyncio
-import pandas as pd
-from bs4 import BeautifulSoup
-from supabase import create_client
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+from supabase import Client, ClientOptions, create_client
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,7 +20,12 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 TABLE_NAME = "products"
-BASE_URL = "https://shopdunssweden.se/"
+MAX_CONCURRENT_FETCHES = 8
+UPSERT_BATCH_SIZE = 500
+# Telegram rejects messages over 4096 characters; leave room for markup.
+MESSAGE_CHUNK_SIZE = 3500
+SHOP_URL = "https://shopdunssweden.se"
+BASE_URL = f"{SHOP_URL}/"
 MENU_LINKS = [
     {"name": "Home", "href": "/"},
     {"name": "Radish", "href": "/collections/radish/radish"},
@@ -43,111 +53,146 @@ MENU_LINKS = [
     },
     {"name": "Babycap", "href": "/collections/babycap"},
 ]
-
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+PRODUCT_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("title", pa.string()),
+        ("handle", pa.string()),
+        ("url", pa.string()),
+    ]
+)
+PRODUCT_VARIANT_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("title", pa.string()),
+        ("name", pa.string()),
+        ("available", pa.bool_()),
+        ("product_id", pa.int64()),
+    ]
+)
+MENU_URLS = tuple(urljoin(BASE_URL, item["href"]) for item in MENU_LINKS)
+PRODUCT_SCRIPT_RE = re.compile(
+    rb'<script[^>]*class="[^"]*bc-sf-filter-product-script[^"]*"[^>]*>(.*?)</script>',
+    re.S,
+)
+
+
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    # postgrest uses an injected client as-is, so its timeout is the one that
+    # applies; ClientOptions.postgrest_client_timeout would be ignored.
+    httpx_client = httpx.Client(
+        http2=True,
+        timeout=10,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=8),
+    )
+    return create_client(
+        SUPABASE_URL,
+        SUPABASE_KEY,
+        options=ClientOptions(httpx_client=httpx_client),
+    )
 
 
 async def fetch_product_data(
     client: httpx.AsyncClient,
-    href: str,
-) -> pd.DataFrame:
-    url = urljoin(BASE_URL, href)
-    response = await client.get(url)
-    soup = BeautifulSoup(response.text, "html.parser")
-    script_tags = soup.find_all(
-        "script",
-        type="application/json",
-        class_="bc-sf-filter-product-script",
-    )
+    semaphore: asyncio.Semaphore,
+    url: str,
+) -> list[dict]:
+    async with semaphore:
+        response = await client.get(url)
 
     product_data_list = []
-    for tag in script_tags:
-        json_data = json.loads(tag.string)
+    for script in PRODUCT_SCRIPT_RE.findall(response.content):
+        json_data = orjson.loads(script)
         product_data_list.append(json_data)
 
-    df = pd.DataFrame(product_data_list)
-    return df
+    return product_data_list
 
 
 async def fetch_all_product_data(
-    menu_links: list[dict],
-) -> tuple[pd.DataFrame, pd.DataFrame]:
-    async with httpx.AsyncClient() as client:
-        tasks = [fetch_product_data(client, item["href"]) for item in menu_links]
-        results = await asyncio.gather(*tasks)
-
-    raw_product_df = pd.concat(results, ignore_index=True)
-
-    PRODUCT_COLUMNS = ["id", "title", "handle", "url"]
-    product_df = (
-        raw_product_df[PRODUCT_COLUMNS].drop_duplicates().reset_index(drop=True)
-    )
-    product_df_exploded = raw_product_df.rename(columns={"id": "product_id"}).explode(
-        "variants"
-    )
-    product_variant_product_id_df = (
-        pd.json_normalize(product_df_exploded["variants"])[["id"]]
-        .set_index(product_df_exploded["product_id"])
-        .drop_duplicates()
-        .reset_index()
-    )
-
-    PRODUCT_VARIANT_COLUMNS = ["id", "title", "name", "available"]
-    product_variant_df = (
-        pd.DataFrame.from_records(raw_product_df["variants"].sum())[
-            PRODUCT_VARIANT_COLUMNS
-        ]
-        .drop_duplicates()
-        .merge(
-            product_variant_product_id_df,
-            on="id",
-            how="left",
+    client: httpx.AsyncClient,
+    menu_urls: tuple[str, ...],
+) -> tuple[pa.Table, pa.Table]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    tasks = [fetch_product_data(client, semaphore, url) for url in menu_urls]
+    results = await asyncio.gather(*tasks)
+
+    product_rows = []
+    product_variant_rows = []
+    seen_product_ids = set()
+    seen_variant_ids = set()
+    for product in chain.from_iterable(results):
+        product_id = product["id"]
+        if product_id in seen_product_ids:
+            continue
+        seen_product_ids.add(product_id)
+        product_rows.append(
+            {
+                "id": product_id,
+                "title": product["title"],
+                "handle": product["handle"],
+                "url": product["url"],
+            }
         )
+        for variant in product["variants"]:
+            variant_id = variant["id"]
+            if variant_id in seen_variant_ids:
+                continue
+            seen_variant_ids.add(variant_id)
+            product_variant_rows.append(
+                {
+                    "id": variant_id,
+                    "title": variant["title"],
+                    "name": variant["name"],
+                    "available": variant["available"],
+                    "product_id": product_id,
+                }
+            )
+
+    product_table = pa.Table.from_pylist(product_rows, schema=PRODUCT_SCHEMA)
+    product_variant_table = pa.Table.from_pylist(
+        product_variant_rows, schema=PRODUCT_VARIANT_SCHEMA
     )
 
-    return (product_df, product_variant_df)
+    return (product_table, product_variant_table)
 
 
-def insert_product_to_supabase(product_df: pd.DataFrame) -> None:
-    if product_df.empty:
+def insert_product_to_supabase(product_table: pa.Table) -> None:
+    if product_table.num_rows == 0:
         print("No product data to insert.")
         return
 
-    data = product_df.to_dict(orient="records")
-    supabase.table(table_name="products").insert(data).execute()
-
-
-def get_product_ids_from_supabase() -> list[int]:
-    response = supabase.table(table_name="products").select("id").execute()
-    df = pd.DataFrame.from_records(response.data)
-    return df["id"].tolist()
-
-
-def get_available_product_variant_ids_from_supabase() -> list[int]:
-    response = (
-        supabase.table(table_name="product_variants")
-        .select("id")
-        .eq("available", True)
-        .execute()
-    )
-    df = pd.DataFrame.from_records(response.data)
-    return df["id"].tolist()
+    data = product_table.to_pylist()
+    postgrest = get_supabase().postgrest
+    url = f"{str(postgrest.base_url).rstrip('/')}/{TABLE_NAME}"
+    headers = {
+        **postgrest.headers,
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    }
+    for i in range(0, len(data), UPSERT_BATCH_SIZE):
+        response = postgrest.session.post(
+            url,
+            params={"on_conflict": "id"},
+            content=orjson.dumps(data[i : i + UPSERT_BATCH_SIZE]),
+            headers=headers,
+        )
+        response.raise_for_status()
 
 
-def update_product_variant_to_supabase(product_variant_df: pd.DataFrame) -> None:
-    if product_variant_df.empty:
+def update_product_variant_to_supabase(product_variant_table: pa.Table) -> None:
+    if product_variant_table.num_rows == 0:
         print("No product variant data to insert.")
         return
 
-    data = product_variant_df.to_dict(orient="records")
-    supabase.table(table_name="product_variants").delete().neq("id", 99999999).execute()
-    supabase.table(table_name="product_variants").insert(data).execute()
+    data = product_variant_table.to_pylist()
+    get_supabase().rpc("refresh_product_variants", {"payload": data}).execute()
 
 
-def get_chat_ids_from_supabase() -> list[int]:
-    response = supabase.table(table_name="chats").select("id").execute()
-    df = pd.DataFrame.from_records(response.data)
-    return df["id"].tolist()
+def get_bootstrap_state_from_supabase() -> dict[str, list[int]]:
+    response = get_supabase().rpc("bootstrap_state").execute()
+    return cast(dict[str, list[int]], response.data)
 
 
 def get_bot_updates() -> dict:
@@ -157,72 +202,142 @@ def get_bot_updates() -> dict:
     return res.json()
 
 
-def send_message_to_chat(chat_id: int, message: str) -> None:
+async def send_message_to_chat(
+    client: httpx.AsyncClient,
+    chat_id: int,
+    message: str,
+) -> None:
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": chat_id, "text": message, "parse_mode": "Markdown"}
-    with httpx.Client() as client:
-        client.post(url, data=payload)
+    payload = {"chat_id": chat_id, "text": message, "parse_mode": "HTML"}
+    await client.post(url, data=payload)
 
 
-def generate_new_product_alert_message(new_product_df: pd.DataFrame) -> str:
+async def send_messages_to_chat(
+    client: httpx.AsyncClient,
+    chat_id: int,
+    messages: list[str],
+) -> None:
+    # Chunks for one chat go out in order; chats are fanned out by the caller.
+    for message in messages:
+        await send_message_to_chat(client, chat_id, message)
+
+
+def chunk_message_lines(message_lines: list[str]) -> list[str]:
+    messages: list[str] = []
+    chunk: list[str] = []
+    chunk_size = 0
+    for line in message_lines:
+        if chunk and chunk_size + len(line) + 1 > MESSAGE_CHUNK_SIZE:
+            messages.append("\n".join(chunk))
+            chunk = []
+            chunk_size = 0
+        chunk.append(line)
+        chunk_size += len(line) + 1
+    if chunk:
+        messages.append("\n".join(chunk))
+    return messages
+
+
+def generate_new_product_alert_messages(new_product_table: pa.Table) -> list[str]:
     message_lines: list[str] = ["🆕 [신상 입고 알림]\n"]
 
-    for idx, row in new_product_df.iterrows():
-        title = row["title"]
-        url = f"https://shopdunssweden.se{row['url']}"
-
-        msg = f"""**{title}**
-🔗 [상품보기]({url})\n"""
-        message_lines.append(f"{idx + 1}. {msg}")
+    titles = new_product_table["title"].to_pylist()
+    urls = pc.binary_join_element_wise(
+        SHOP_URL, new_product_table["url"], ""
+    ).to_pylist()
+    for i, (title, url) in enumerate(zip(titles, urls), start=1):
+        msg = f"""<b>{escape(title)}</b>
+🔗 <a href="{escape(url)}">상품보기</a>\n"""
+        message_lines.append(f"{i}. {msg}")
 
-    return "\n".join(message_lines)
+    return chunk_message_lines(message_lines)
 
 
-def generate_restock_alert_message(
-    new_available_product_variant_df: pd.DataFrame,
-) -> str:
-    message_lines = ["🔔 *[재고 알림]*\n"]
+def generate_restock_alert_messages(
+    new_available_product_variant_table: pa.Table,
+) -> list[str]:
+    message_lines = ["🔔 <b>[재고 알림]</b>\n"]
 
-    for idx, row in new_available_product_variant_df.iterrows():
-        name = row.get("name", "").strip()
-        url = f"https://shopdunssweden.se{row['url'].strip()}"
+    names = pc.utf8_trim_whitespace(
+        new_available_product_variant_table["name"]
+    ).to_pylist()
+    urls = pc.binary_join_element_wise(
+        SHOP_URL,
+        pc.utf8_trim_whitespace(new_available_product_variant_table["url"]),
+        "",
+    ).to_pylist()
+    for i, (name, url) in enumerate(zip(names, urls), start=1):
+        msg = f"""<b>{escape(name)}</b>\n🔗 <a href="{escape(url)}">상품보기</a>\n"""
+        message_lines.append(f"{i}. {msg}")
 
-        msg = f"""*{name}*\n🔗 [상품보기]({url})\n"""
-        message_lines.append(f"{idx + 1}. {msg}")
-
-    return "\n".join(message_lines)
+    return chunk_message_lines(message_lines)
 
 
 async def main() -> None:
-    product_df, product_variant_df = await fetch_all_product_data(MENU_LINKS)
-    chat_ids = get_chat_ids_from_supabase()
-    product_ids = get_product_ids_from_supabase()
-    new_product_df = product_df.loc[lambda x: ~x["id"].isin(product_ids)]
-    if not new_product_df.empty:
-        # message = generate_new_product_alert_message(new_product_df)
-        # for chat_id in chat_ids:
-        #     send_message_to_chat(chat_id, message)
-        insert_product_to_supabase(new_product_df)
-
-    available_product_variant_ids = get_available_product_variant_ids_from_supabase()
-    new_available_product_variant_df = product_variant_df.query("available").loc[
-        lambda x: ~x["id"].isin(available_product_variant_ids)
-    ]
-
-    if not new_available_product_variant_df.empty:
-        new_available_product_variant_df_with_product_info = (
-            new_available_product_variant_df.merge(
-                product_df.drop(columns=["title"]).rename(columns={"id": "product_id"}),
-                on="product_id",
-                how="left",
-            )
+    transport = httpx.AsyncHTTPTransport(
+        retries=2,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=32,
+            max_keepalive_connections=32,
+            keepalive_expiry=30,
+        ),
+    )
+    async with httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(10.0),
+    ) as client:
+        product_table, product_variant_table = await fetch_all_product_data(
+            client, MENU_URLS
         )
-        message = generate_restock_alert_message(
-            new_available_product_variant_df_with_product_info
+        state = get_bootstrap_state_from_supabase()
+        chat_ids = state["chat_ids"]
+        product_ids = pa.array(state["product_ids"], type=pa.int64())
+        new_product_table = product_table.filter(
+            pc.invert(pc.is_in(product_table["id"], value_set=product_ids))
         )
-        for chat_id in chat_ids:
-            send_message_to_chat(chat_id, message)
-        update_product_variant_to_supabase(product_variant_df)
+        if new_product_table.num_rows > 0:
+            # messages = generate_new_product_alert_messages(new_product_table)
+            # await asyncio.gather(
+            #     *[send_messages_to_chat(client, chat_id, messages) for chat_id in chat_ids]
+            # )
+            insert_product_to_supabase(new_product_table)
+
+        available_product_variant_ids = pa.array(
+            state["available_variant_ids"], type=pa.int64()
+        )
+        available_product_variant_table = product_variant_table.filter(
+            product_variant_table["available"]
+        )
+        new_available_product_variant_table = available_product_variant_table.filter(
+            pc.invert(
+                pc.is_in(
+                    available_product_variant_table["id"],
+                    value_set=available_product_variant_ids,
+                )
+            )
+        )
+
+        if new_available_product_variant_table.num_rows > 0:
+            product_index = pc.index_in(
+                new_available_product_variant_table["product_id"],
+                value_set=product_table["id"],
+            )
+            new_available_product_variant_table_with_product_info = (
+                new_available_product_variant_table.append_column(
+                    "url", pc.take(product_table["url"], product_index)
+                )
+            )
+            messages = generate_restock_alert_messages(
+                new_available_product_variant_table_with_product_info
+            )
+            await asyncio.gather(
+                *[
+                    send_messages_to_chat(client, chat_id, messages)
+                    for chat_id in chat_ids
+                ]
+            )
+            update_product_variant_to_supabase(product_variant_table)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,18 @@
+-- Everything main() needs to know about the stored state, in one round trip.
+create or replace function bootstrap_state()
+returns json
+language sql
+stable
+as $$
+  select json_build_object(
+    'chat_ids',
+    coalesce((select json_agg(id) from chats), '[]'::json),
+    'product_ids',
+    coalesce((select json_agg(id) from products), '[]'::json),
+    'available_variant_ids',
+    coalesce(
+      (select json_agg(id) from product_variants where available),
+      '[]'::json
+    )
+  );
+$$;
@@ -0,0 +1,28 @@
+-- Replace the stored variants with the scraped set in a single transaction.
+-- Unchanged rows are left untouched; rows missing from the payload are removed.
+create or replace function refresh_product_variants(payload jsonb)
+returns void
+language plpgsql
+as $$
+begin
+  insert into product_variants (id, product_id, title, name, available)
+  select id, product_id, title, name, available
+  from jsonb_populate_recordset(null::product_variants, payload)
+  on conflict (id) do update
+  set
+    product_id = excluded.product_id,
+    title = excluded.title,
+    name = excluded.name,
+    available = excluded.available
+  where
+    (product_variants.product_id, product_variants.title,
+     product_variants.name, product_variants.available)
+    is distinct from
+    (excluded.product_id, excluded.title, excluded.name, excluded.available);
+
+  delete from product_variants
+  where id not in (
+    select (x ->> 'id')::bigint from jsonb_array_elements(payload) x
+  );
+end;
+$$;